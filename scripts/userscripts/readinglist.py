@@ -9,20 +9,33 @@ if False:
     import logging
     logging.basicConfig(level=1)
 
-import base64
 import email
+import email.parser
 import email.policy
 import imaplib
+import itertools
 import logging
 import pywikibot
 import re
-import urllib
-import urllib3
 
 from pywikibot.bot import CurrentPageBot, SingleSiteBot
+from urllib.parse import unquote
 
 logger = logging.getLogger(__name__)
 
+# Run with -debug:readinglist (or -debug) to dump every message
+# handled, Ascii85-encoded, for fetch_readinglist_tests.py.
+dump_logger = logging.getLogger("pywiki.readinglist")
+
+# Messages with any of these headers were sent to someone other
+# than the bot, and are never processed.
+RECIPIENT_HEADERS = ("to", "cc", "bcc")
+
+_header_parser = email.parser.BytesHeaderParser(policy=email.policy.default)
+
+# Bytes handed to the feed parser per call.
+FEED_CHUNK_SIZE = 8192
+
 class IMAP4JobQueue(imaplib.IMAP4_SSL):
     def __init__(self, *args, **kwargs):
         user = kwargs.pop("user", None)
@@ -41,46 +54,136 @@ class IMAP4JobQueue(imaplib.IMAP4_SSL):
             raise self.error(dat[-1].decode(errors="ignore"))
         return dat
 
+    _UID_RE = re.compile(rb"\bUID (\d+)")
+
     @property
-    def _messages(self):
+    def _headers(self):
+        """Yield (uid, msg) for every message, with msg headers only."""
         logger.debug(f"selecting {self.mailbox}")
         data = self._chk(self.select(self.mailbox))
         if data and data[0] == b"0":
             return
-        logger.debug("fetching messages")
-        for data in self._chk(self.fetch("1:*", "(UID RFC822)")):
-            # Each data is either a string, or a tuple.
-            if not isinstance(data, tuple):
-                assert data == b")" # XXX why?
+        logger.debug("fetching headers")
+        fields = " ".join(RECIPIENT_HEADERS + ("subject",)).upper()
+        fields = f"(UID BODY.PEEK[HEADER.FIELDS ({fields})])"
+        data = self._chk(self.uid("FETCH", "1:*", fields))
+        # Each item is either a string, or a tuple whose second
+        # part contains the data (ie: 'literal' value).  The UID
+        # is usually before the literal, but may follow it.
+        headers = None
+        for item in data:
+            if isinstance(item, tuple):
+                item, headers = item
+            match = self._UID_RE.search(item)
+            if match is not None and headers is not None:
+                yield match.group(1), _header_parser.parsebytes(headers)
+                headers = None
+
+    def _messages(self, imap_uids):
+        # Fetch each message individually, so that at most one
+        # message body is held in memory at any one time.  Using
+        # BODY.PEEK[] rather than RFC822 leaves the flags alone.
+        for imap_uid in imap_uids:
+            logger.debug(f"fetching UID {imap_uid}")
+            data = self._chk(self.uid("FETCH", imap_uid, "(BODY.PEEK[])"))
+            # Keep only the literal, and pop it on yielding so that
+            # this frame holds no reference while the consumer works
+            # on it.
+            data = [item[1] for item in data if isinstance(item, tuple)]
+            if not data:
+                logger.warning(f"UID {imap_uid} vanished")
                 continue
-            # If a tuple, then the first part is the header
-            # of the response, and the second part contains
-            # the data (ie: 'literal' value).
-            header, data = data
-            header = header.split()
-            assert header[1] == b"(UID"
-            assert header[-2] == b"RFC822"
-            assert header[-1] == b"{%d}" % len(data)
-            imap_uid = header[2]
-            yield imap_uid, data
+            yield imap_uid, data.pop()
 
     @property
     def messages(self):
-        for imap_uid, data in self._messages:
+        # Only fetch the bodies of messages that entry_for could accept.
+        # Strip subjects exactly as entry_for does.
+        subjects = {imap_uid: (headers["subject"] or "").strip()
+                    for imap_uid, headers in self._headers
+                    if not is_addressed(headers)}
+        for imap_uid, data in self._messages(subjects):
+            if subjects[imap_uid] and not may_contain_url(data):
+                # entry_for requires a URL when there's a subject.
+                logger.info(f"skipping UID {imap_uid}: no URL found")
+                continue
             logger.debug(f"handling UID {imap_uid}")
             msg = email_from_bytes(data)
-            for header in ("to", "cc", "bcc"):
-                if msg[header]:
-                    continue
-            encoded_bytes = base64.a85encode(data, wrapcol=72)
-            pywikibot.output(f"{encoded_bytes.decode('ascii')}\n")
+            if dump_logger.isEnabledFor(logging.DEBUG):
+                import base64
+                encoded_bytes = base64.a85encode(data, wrapcol=72)
+                pywikibot.output(f"{encoded_bytes.decode('ascii')}\n")
+            # The message holds its own copy of everything it needs.
+            del data
             assert not hasattr(msg, "uid")
             msg.uid = imap_uid
             yield msg
 
 def email_from_bytes(data):
-    return email.message_from_bytes(
-        data, policy=email.policy.default)
+    """Parse data, skipping any non-text MIME parts."""
+    msg = _header_parser.parsebytes(data[:_header_end(data)])
+    if _is_strippable(msg):
+        data = _strip_nontext_parts(data, msg.get_boundary())
+    parser = email.parser.BytesFeedParser(policy=email.policy.default)
+    for start in range(0, len(data), FEED_CHUNK_SIZE):
+        parser.feed(data[start:start + FEED_CHUNK_SIZE])
+    return parser.close()
+
+def is_addressed(msg):
+    """Return True if msg has any recipient headers."""
+    return any(msg[header] for header in RECIPIENT_HEADERS)
+
+# Cheap test for whether a raw message could contain a URL.  Base64
+# and quoted-printable bodies, and bodies in charsets that don't
+# encode ASCII as ASCII, are let through, since they can hide a URL
+# from a byte scan.
+_MAYBE_URL_RE = re.compile(
+    rb"http|base64|quoted-printable|utf-?(?:16|32)|ucs-?[24]", re.I)
+
+def may_contain_url(data):
+    """Return False if data is unlikely to contain a URL."""
+    return _MAYBE_URL_RE.search(data) is not None
+
+def _header_end(data, start=0):
+    """Return the index just past the header block at data[start:]."""
+    if data.startswith((b"\n", b"\r\n"), start):
+        return start
+    ends = (data.find(b"\n\n", start), data.find(b"\n\r\n", start))
+    return min((end + 1 for end in ends if end >= 0), default=len(data))
+
+def _is_strippable(msg):
+    """Return True if non-text parts may be dropped from msg.
+
+    get_body only considers the root part of a multipart/related,
+    so dropping an image root could let a later text part through.
+    """
+    return (msg.get_content_maintype() == "multipart"
+            and msg.get_content_subtype() != "related")
+
+def _strip_nontext_parts(data, boundary):
+    """Drop every non-text, non-multipart part of a multipart body."""
+    if not boundary:
+        return data
+    delimiter = b"\n--" + boundary.encode("ascii", errors="ignore")
+    # Only split where the boundary fills the whole line, so that
+    # e.g. "--BB" doesn't match a nested part's "--BBinner".
+    parts = re.split(re.escape(delimiter)
+                     + rb"(?=(?:--)?[ \t]*(?:\r?\n|\r|\Z))", data)
+    kept = parts[:1]
+    for part in parts[1:]:
+        if part.startswith(b"--"):
+            kept.append(part)  # the close-delimiter and epilogue
+            continue
+        start = part.find(b"\n") + 1
+        headers = _header_parser.parsebytes(
+            part[start:_header_end(part, start)])
+        maintype = headers.get_content_maintype()
+        if _is_strippable(headers):
+            part = _strip_nontext_parts(part, headers.get_boundary())
+        elif maintype not in ("text", "multipart"):
+            continue
+        kept.append(part)
+    return delimiter.join(kept)
 
 class Robot(SingleSiteBot, CurrentPageBot):
     def __init__(self, **kwargs):
@@ -96,47 +199,83 @@ class Robot(SingleSiteBot, CurrentPageBot):
 
     @property
     def generator(self):
-        self.entries = []
+        self.entries, deleted_uids, seen = [], [], set()
         for msg in self.mbox.messages:
             entry = self.entry_for(msg)
             if entry is None:
                 continue
-            self.entries.append(entry)
-            self.mbox._chk(self.mbox.uid("STORE", msg.uid,
-                                         "+FLAGS", r"\Deleted"))
+            # Duplicates would only be stripped by treat_page, so
+            # drop them here, but still flag them as processed.
+            key = self.entry_key("* " + entry)
+            if key not in seen:
+                seen.add(key)
+                self.entries.append(entry)
+            deleted_uids.append(msg.uid)
+        if deleted_uids:
+            # Flag everything in one round trip.
+            uid_set = b",".join(deleted_uids)
+            self.mbox._chk(self.mbox.uid("STORE", uid_set,
+                                         "+FLAGS.SILENT", r"(\Deleted)"))
         if self.entries:
             yield pywikibot.Page(self.site, "Reading list")
 
     def treat_page(self):
-        # Add the new entries.
-        bits = [self.current_page.text.rstrip()]
-        bits.extend(self.entries)
-        text = "\n* ".join(bits) + "\n"
-        # Strip duplicate entries.
-        lines, seen = [], {}
-        for line in text.rstrip().split("\n"):
-            m = re.match(r"\*\s*(\{\{at\|.*?\}\}\s*)?", line)
-            if m is not None:
-                entry = line[len(m.group(0)):]
+        # Split the existing text, dropping trailing whitespace.
+        existing_lines = self.current_page.text.split("\n")
+        while len(existing_lines) > 1 and not existing_lines[-1].strip():
+            existing_lines.pop()
+        existing_lines[-1] = existing_lines[-1].rstrip()
+        # Add the new entries, stripping duplicates as we go.
+        lines, seen = [], set()
+        seen_add, entry_key = seen.add, self.entry_key
+        for line in itertools.chain(
+                existing_lines,
+                itertools.chain.from_iterable(("* " + entry).split("\n")
+                                              for entry in self.entries)):
+            entry = entry_key(line)
+            if entry is not None:
                 if entry in seen:
                     continue
-                seen[entry] = True
-                line
+                seen_add(entry)
             lines.append(line)
+        lines.append("")
         # Store the updated wikitext.
-        self.put_current("\n".join(lines) + "\n",
+        self.put_current("\n".join(lines),
                          show_diff=(not self.getOption("always")),
                          asynchronous=False)
         self.mbox._chk(self.mbox.expunge())
 
-    REWRITES = (
-        (r"^https?://en\.(m\.)?wikipedia\.org/wiki/", "wikipedia:"),
-        (r"^https?://youtu\.be/", "https://www.youtube.com/watch?v="),
-        (r"\?igshid=[a-z0-9+/]*={0,2}", ""),
-    )
+    @staticmethod
+    def entry_key(line):
+        """Return the deduplication key for line, or None."""
+        if not line.startswith("*"):
+            return None
+        key = line[1:].lstrip()
+        if key.startswith("{{at|"):
+            end = key.find("}}")
+            if end >= 0:
+                key = key[end + 2:].lstrip()
+        return key
+
+    # Each pattern is only tried if its needle (a lowercase
+    # substring of anything it could match) is in the entry.
+    REWRITES = tuple((needle, re.compile(pattern, re.I), repl)
+                     for needle, pattern, repl in (
+        ("wikipedia.org/wiki/",
+         r"^https?://en\.(m\.)?wikipedia\.org/wiki/", "wikipedia:"),
+        ("youtu.be/",
+         r"^https?://youtu\.be/", "https://www.youtube.com/watch?v="),
+        ("igshid=",
+         r"\?igshid=[a-z0-9+/]*={0,2}", ""),
+    ))
 
     @classmethod
     def entry_for(cls, msg):
+        if is_addressed(msg):
+            return
+        subject, date = msg["subject"], msg["date"]
+        if subject is not None:
+            subject = subject.strip()
         body = msg.get_body(('plain',))
         if body is None:
             return
@@ -151,16 +290,15 @@ class Robot(SingleSiteBot, CurrentPageBot):
             return
         if entry.startswith("<") and entry.endswith(">"):
             entry = entry[1:-1]
-        subject = msg["subject"]
-        if subject is not None:
-            subject = subject.strip()
         if subject:
             if entry.split(":", 1)[0].lower() not in ("http", "https"):
                 return
-        for pattern, repl in cls.REWRITES:
-            entry = re.sub(pattern, repl, entry, 1, re.I)
+        lower_entry = entry.lower()
+        for needle, pattern, repl in cls.REWRITES:
+            if needle in lower_entry:
+                entry = pattern.sub(repl, entry, 1)
         if entry.startswith("wikipedia:"):
-            entry = urllib.parse.unquote(entry).replace("_", " ")
+            entry = unquote(entry).replace("_", " ")
             entry = "[[%s]]" % entry
             if subject:
                 entry = "%s ''<q>%s</q>''" % (entry, subject)
@@ -168,13 +306,14 @@ class Robot(SingleSiteBot, CurrentPageBot):
             entry = "%s %s" % (entry, subject)
             if "[" not in entry and "]" not in entry:
                 entry = "[%s]" % entry
-        date = msg["date"]
         if date is not None:
             entry = "{{at|%s}} %s" % (date, entry)
         if body is not None:
             entry = "%s %s" % (entry, body)
         return entry
 
+NETWORK_ERROR_PREFIX = "An error occurred for uri "
+
 class LogScrobbler(logging.Filterer):
     def __init__(self, logger):
         super(LogScrobbler, self).__init__()
@@ -192,37 +331,36 @@ class LogScrobbler(logging.Filterer):
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.logger.removeFilter(self)
         # If it looks like we succeeded then lose network errors
+        records = self.records
         if exc_type is None and self.success_message_seen:
-            self.purge_network_errors()
+            records = itertools.filterfalse(self.is_network_error, records)
         # Feed the remaining records back into the system
-        for record in self.records:
+        for record in records:
             self.logger.handle(record)
 
-    SUCCESS_MESSAGES = (
+    SUCCESS_MESSAGES = frozenset((
         "Page [[Reading list]] saved",
         "No changes were needed on [[Reading list]]",
-    )
+    ))
 
     @property
     def success_message_seen(self):
         for record in reversed(self.records):
+            if record.levelname != "INFO":
+                continue
             if record.msg in self.SUCCESS_MESSAGES:
                 return True
         return False
 
-    def purge_network_errors(self):
-        self.records = [record
-                        for record in self.records
-                        if not self.is_network_error(record)]
-
     @classmethod
     def is_network_error(cls, record):
         if record.levelname != "ERROR":
             return False
-        if record.msg.startswith("An error occurred for uri "):
+        if record.msg.startswith(NETWORK_ERROR_PREFIX):
             return True
         if not record.exc_info:
             return False
+        import urllib3
         if isinstance(record.exc_info[1], urllib3.exceptions.HTTPError):
             return True
         pywikibot.output(f"{record.exc_info!r}")
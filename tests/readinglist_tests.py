@@ -5,11 +5,16 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import email
+import email.policy
+
 from base64 import a85decode
 from parameterized import parameterized
 from unittest import TestCase
+from unittest.mock import patch
 
-from scripts.userscripts.readinglist import email_from_bytes, Robot
+from scripts.userscripts.readinglist import (
+    email_from_bytes, IMAP4JobQueue, may_contain_url, Robot)
 
 # nosetests -v tests/readinglist_tests.py
 
@@ -118,6 +123,22 @@ edJ71BS5$>=O'E-"&n04f#a1.?%C1.?D$CM@a!A8,I81.?,%B.nICCM>FqARTY%?Xn"kD/X<
 
          ),
 
+        ("URL-only Wikipedia link, percent-encoded",
+         r'''
+6t(1K3ZqL8A1SiW1a#D!DBL\g1,C%,3'&cL3]&N5.kiY20F\@YEc5eU+@fj\Gp#FbDKB`6+?
+X:FEd9o_@V'FuDf.1FATU*F$<)(VC1Ums3Znk=<HD_l/O=#\DKIo^9.`.H9jqaP+D,P4+@0m
+UEc5Z&%15g@F)tc&AM$JA3ZpOD757+b5rCDL0LIZb/MomR2(^gT0L[QL7Q*Oe6o%+h75QqgB
+4>FiF)PqKDImoR%15g$9gpX7ATDj+Df.TY0eP-h$:A`LFCf?3/Q@"7ANCrUAU&;ME,8rsDEA
+:7+Cf(nEcYf64`tjY/N=1H6Z6jaASuTA<,uDbF(T!(/OaPeDe*R"B0%/TF`2A5A1_b@Bl8$$
+@VfTb$<SlQ3Gi2=Cb84hASuU(FEoni+`';!1F@$'0ICd\4]#$F7S-]/Aj'*^=B$Vd4YS4&4\
+edJ71BS5$>=O'E-"&n04f#a1.?%C1.?D$CM@a!A8,I81.?,%B.nICCM>Fh@:gfQ1F5=I?X\(
+aCgh%"''',
+
+         '{{at|Wed, 04 Jan 2023 08:12:40 +0000}} '
+         '[[wikipedia:Café au lait]]'
+
+         ),
+
         ("URL+subject Wikipedia link",
          r'''
 6t(1K3Zq@0F=\Oh0H`bp@j!N\1,9t,0KLmF3\rW9.kiY20F\@YEc5eU+@fj\Gp#FbDKB`6+?
@@ -149,8 +170,347 @@ TY0eP-h$:A`LFCf?3/Q@"7ANCrUAU&;ME,8rsDEA:7+Cf(nEcYf64`tjY/N=1H6Z6jaASuTA
          '[https://www.instagram.com/reel/Cl6fxqKgDmy/ '
          'Leclerc compact loom/how it fold]'
 
+         ),
+
+        ("URL+subject generic link, multipart/mixed with attachments",
+         r'''
+6t(1K3Zq@0F=\Oh1a#D!DBL\g1,C%-0fh'D3\WE6.kiY20F\@YEc5eU+@fj\Gp#FbDKB`6+?
+X:FEd9o_@V'FuDf.1FATU*F$<)(VC1Ums3Zq+7Df$V9@<-I2+Dbb5F:ARWF(KAD6"abHF?1O
+;/NFqJ@;0O#AoD]46#L4RDeW_k$;G)QF(&]m/P/>k+?VGL0LIid2DHd=68q=b1dj;h/NH0Q2
+(^^T1dWr`2afAi1GD(,@V'FuDf.1FATU*F$;F)d74hPOEcYr5DE8mp/hd_A6Z6jaASuTA<-`
+Fo3Zr9^CijB1@<-HCD/"6+A31oCDfor.@<-WV+tYAu/Q#V)=ti].6T@t$=#*E-8i]U%68hjg
+%13OO/M/P+/M0h%0j68+1da6#2-2P+2bH))1I=!#%15I@DKKH-F=gI;E+M'QFCf]=05t`9Bl
+6!A$6Whl@<-F#F?ObgAh>tO$:A`LFCf?3/Q?b!DKBE$E\0^t@rGmlDJ)!QEHQ2AARmB3EbTE
+5@:F%a%13OOBQS?8F#ks-GB\6o1.>c!@;Tt"AN_e;@rH3;Ci=6/F"_K@Ecc@3$8!h]/M/PO=
+><u5:,G<t;DhN29/fI'9f#*o<XfC'Df0Z.DKII0H#R=U+DG\$B4W`8DJ)$RDIIBn4X+iREcc
+@TE,K;4%15I@DKKH-F=fmpF)Z&=Bln'-DE8nKFECr$BPh<uF?:UWBl%?u@;TR=,&gt2FE9'R
+DJ(.&$:A`LFCf?3/Q?b!DKBE$E\0^t@rGmlDJ)!Q@UX=h2DbjM%15Be770@b;+<lb@nB$bDb
+NPb0Mb)]5uL-b9iXY\=]e0\CLK_XG@X6X3+kf]8SUjb<Gb?RB5gLXF)t#R1j2S]7<qUR;)(g
+\@l+W%:K26k:dcuf:bY4&;/8oq;H6mk;akLq;_WGk<,4Kk<E;^k<^p+k<\\8k=);tg=B7:k=
+[tqq=Y`lk>&@eg@97Dg@Ri.q@P^>q%16T_:,$3\=u-Tp/M/P+/M0h%0j68+1da6#2-2P+2bH
+))1I=!#%15I@DKKH-F=gI;E+M'Q@;p1%Bk(RnBl@lBE+EQB+DtV)AN_5V@<-I2/oY?5+q4lH
+Df0Z.DKIHuBle63F(o`1Df.TY@<?U"@q]^jDKIr_Anc'mDIIBn4X+iREcc@TE+EQ)%15I@DK
+KH-F=gI4@;^-uATB@kDI[TqBl7QE+C\c#AMu@S$4R>7<^K5QBeXd*C/IVi5t+.,G>UgrB4FM
+#;/],r5ql)&GX54rBMDJr;H[*l6>L""G^![hBK0Wr;b:^r6WItqH"V(hBle>h;`&Y,$;EoWG
+tiT^0huIn1f%(h2[p*G/M/P+/Q#V)=ti].6T@t$=#*E-8i]U%68hjr/I`$''',
+
+         '{{at|Sat, 14 Jan 2023 11:20:05 +0000}} '
+         '[https://www.example.com/looms/parts Loom parts list]'
+
+         ),
+
+        ("URL-only Wikipedia link, nested multipart/alternative",
+         r'''
+6t(1K3Zq@DDCcnb2'>M"DBL\g1,C%-3BAuP3]/W7.kiY20FC9iDf%NX7q$F`+@9XWF)Pq=4D
+/)CGsH"OASuR-DD#g<F?U%1F^f)s@rsaS$;F)d74hPOEcYr5DE8mp/hdW"Df0Z.DKII0H#R=
+U+Dl7;FD5]&Ec`sOBm=3"4!8!NF`(_uEd9elDfp/5E\04[0kMU:$<1\QF!,1<+CQC0F_l/6/
+T>-=F<GF3F)tc&AKY])+AGF%73H2\Ec#6,/da0^Dfp/5E\04[0kLb[Df0Z.DKII0H#R=U+Dl
+7;FD5]&Ec`sCCij6/DIIX$G%E`X@W-C,A79M(4X+TXDImi?AN;PT+pnZ//ST*?ATBA63AY(N
+6Z6jaASuTA<-`Fo3ZrNUG]YTXCgh$q4!8$H@<-F#F?ObgAh>tL6Z6jaASuTA<,uDbF(T!(/O
+aPeDe*R"B0%.o@VKok$>=O'E-"&n04f#RGA1i,E+NQo@4lJ=B.nICCM>FnDJO'"?[$'iG%ki
+,$8!iDDJj$+/S-pu@1#A?DKKH-F=gI;E+M'QFCf]=05,HECc`bLBOPq&ATU(XFCm*a$:A`LF
+Cf?3/Q?b!DKBE$E\0^t@rGmlDJ)!Q2e$KC$48n75!36rBQ@Zr4X+Q]FDu:^0/$mS/pD#FBlI
+WoBjiW4Eb@%LBkqE98T&<[ARBXm@<Q@&B-KNUBl7]K04@%,05s)^/M1[SDImi?AN;PT/M.;:
+/M1m`FCfJE2e+RS$:A`LFCf?3/Q@"7ANCrJD..'g05>H;B0.5R@;TR=,&(q1Ch556E+^@%6Z
+6jaASuTA6tp^]Df]W7Bl@lM+CTA6@:NtfASuTO+D,>(AStpnAN_5ODJO'"/o#?<+pp\UDKKH
+-F=gI4@;^-uATB@kDI[TqBl7QE+C\c#AMu@P$:-sH6U>on7RC`t8OH?n9LM0#:IKFn;FP7n<
+CTkh=@Y\n@7PQdA4UAnB1Z#nC.^inD+](dE(andF%fLhG"k@nGtiT^0huIn1^[#XD`:K\0Io
+sR6:+Ob:.8&\>"DR\CeI\\GYV4R3DidW8lSh\<``<VBNeJRFCSER2.fu]7VQ!\;J]NRA8bmX
+E,oDX0m-q]6?iiIDGDlr=B[Kf/M1m`FCfJE2e+RS/M.;''',
+
+         '{{at|Sun, 15 Jan 2023 19:42:51 +0000}} '
+         '[[wikipedia:Inkle weaving]]'
+
+         ),
+
+        ("URL+subject generic link, nested boundary with outer as prefix",
+         r'''
+6t(1K3Zq.8DCcnb2BYV#DBL\g1,C%,3'&`N3\`Q9.kiY20F\@YEc5eU+@fj\Gp#FbDKB`6+?
+X:FEd9o_@V'FuDf.1FATU*F$<)(VC1Ums3ZqL4Ec<.2@;KFrCghF(EX`@M8PMW*<b6;mBl@l
+M+>GK&%15I@DKKH-F=gI;E+M'QD09Z:BlIL$F>%KFG\(DI+C]83DId0rGs*?7?Xbr<%13OO/
+M0+m@Q+`'6Z6jaASuTA<-`Fo3Zr9^CijB1@<-HC@;L$sEc,<-Bm+&L+C]83DId0rGs*?7?Xb
+s$@;L$0%13OO/M0+m@Q.Y&Cig*n6Z6jaASuTA<-`Fo3ZrNUG]YTXCgh$q4!8$H@<-F#F?Obg
+Ah>tO$4R>UFEDJC3\N.1GBYZNG[YH.Ch55;Eb@%L@<-<=@ps1`F_kK.DfQ9o/M0+m@Q.Y&Ci
+g*n6Z6jaASuTA<-`Fo3ZrNUG]YTPFDYhU+Cf(nEcYf64`tjY/N=1H%154:5%o%[E-"&n06_V
+a/nK99D/a<&/oPcC06^iFE%PR.Ch%U(@<?F.4>1Y;%14[=4^VYW?X[bm/M.D=%14[=4^VYW%
+15I@DKKH-F=gI;E+M'Q@;p1%Bk(RnBl@lBE+EQB+DtV)AN_5]@<-<>E+EQ)%15I@DKKH-F=g
+I4@;^-uATB@kDI[TqBl7QE+C\c#AMu@S$4R>7<^K5QBeXd*C/IVi5t+.,G>UgrB4FM#;/],r
+5ql)&GX54rBMDJr;H[*l6>L""G^![hBK0Wr;b:^r6WItqH"V(hBle>h;`&Y,$;EoWGtiT^0h
+uIn1f%(h2[p*G/NmHM2_?Tj$3''',
+
+         '{{at|Mon, 16 Jan 2023 08:05:17 +0000}} '
+         '[https://www.example.org/warp-calculator Warp calculator]'
+
+         ),
+
+        ("URL+subject link, multipart/related with image root",
+         r'''
+6t(1K3ZqCEALnrY2]t_$DBL\g1,C%-1HI<H3\WQ:.kiY20F\@YEc5eU+@fj\Gp#FbDKB`6+?
+X:FEd9o_@V'FuDf.1FATU*F$<)(VC1Ums3Zq@7F`__AAKYMt@:sUhD%-hH8PMW*<b6;mBl@l
+M+>GK&%15I@DKKH-F=gI;E+M'QD09Z:BlIL$F>%ZGCghEsA31oCDfor.@<-WV,'%72/Mo1m1
+*R/7%14[=Eb0&=1biMr%15I@DKKH-F=gI;E+M'QBl.9kAM8"?B0.5R@;TR=,'.F?FED>1/oY
+]@+q4lHDf0Z.DKII%6olGQF(f]<FDPMRB4>FiF)PqKDImoR%15I@DKKH-F=gI4@;^-uATB@k
+DI[TqBl7QE+C\c#AMu@S$4R>.5t+.,G>UgrB4FM#;/],r5ql)&GX54rBMDJr;H[*l6>L""G^
+![hBK0Wr;b:^r6WItqH"V(hBle>h;`&Yl6q)AqH;QClC1B(0$;XW>2c)mr.o7od6;_Mn78d,
+h85hrn92dNh:/l!h;,pXh<)uIh=&q%h>$#N^@oubhAm%VnBj!2hCg([dDdc^dEahNnF^d-nG
+RY!iDGDlr=B[Ki$8!iMAS`qT0k<$K$:A`LFCf?3/Q@"7ANCrUAU&;ME,8rsDEAtNBOPq&ATU
+(XFCm*a%13OOBQS?8F#ks-GB\6`AU%X#E,9)<DImoCF(f]<FDPN0%14[=Eb0&=1biMr/M.D=''',
+
+         None
+
+         ),
+
+        ("URL+subject link, nested multipart/related with image root",
+         r'''
+6t(1K3ZqL8A1SiX3$:h%DBL\g1,C%,2``fQ3\rQ7.kiY20FC9iDf%NX7q$F`+@9XWF)Pq=4D
+/)CGsH"OASuR-DD#g<F?U%1F^f)s@rsaS;eU;qFDPM2A8,IbEa`el9hA&J/QQG'F(oQ13Zp.
+00FC0cDKKH-F=gI;E+M'QD09Z:BlIL$F>%KFG\(DI+C]83DId0rGs*?gBm;3`@Q%dA$48@:D
+/"5H0OcqO$:A`LFCf?3/Q@"7ANCrNF_l/6E+*d/061W?@<?'k4!8!NF`(_uEd9elEb0&=3G(
+'W+pnZ//TPE=/NIE!@gYSADKKH-F=gI;E+M'QBl.9kAM8"?B0.5R@;TR=,'.F?FED>1/oY]@
++pp\UDKKH-F=g'P3ZpP+BQ\E=Ch5kE@V'FuDf.1FATU*C6Z6jaASuTA<,uDbF(T!(/OaPeDe
+*R"B0%/E@<6!<1^XRU5t+.,G>UgrB4FM#;/],r5ql)&GX54rBMDJr;H[*l6>L""G^![hBK0W
+r;b:^r6WItqH"V(hBle>h;`&Yl6q)AqH;QClC1B(-:K26k:dcuf:bY4&;/8oq;H6mk;akLq;
+_WGk<,4Kk<E;^k<^p+k<\\8k=);tg=B7:k=[tqq=Y`lk>&@eg@97Dg@Ri.q@P^>q$=dsK0P"
+9h1C>]cEb0&=3G('W$:A`LFCf?3/Q@"7ANCrUAU&;ME,8rsDEAtNBOPq&ATU(XFCm*a$4:Hg
+FDu:^0/%NnG:mHO@;Tt"AM.k3F>%]KF`__AATJ21/TPE=/NIE!@kB8>$8!iHBm;3`@Q%dL/I
+D''',
+
+         None
+
          ),
     ))
     def test(self, name, encoded_msg, expect):
-        msg = email_from_bytes(a85decode(encoded_msg))
+        data = a85decode(encoded_msg)
+        msg = email_from_bytes(data)
+        self.assertEqual(Robot.entry_for(msg), expect)
+        # A full MIME parse must give the same result.
+        msg = email.message_from_bytes(data, policy=email.policy.default)
         self.assertEqual(Robot.entry_for(msg), expect)
+
+
+class TestEmailFromBytes(TestCase):
+
+    """Regression tests for email_from_bytes."""
+
+    def test_addressed_message_body(self):
+        """Messages with recipient headers keep their body."""
+        msg = email_from_bytes(b"To: me@example.com\r\n"
+                               b"Subject: Cron report\r\n"
+                               b"\r\n"
+                               b"hello body\r\n")
+        self.assertEqual(msg.get_body(("plain",)).get_content(),
+                         "hello body\r\n")
+
+
+class TestMayContainURL(TestCase):
+
+    """Regression tests for may_contain_url."""
+
+    @parameterized.expand((
+        ("plain", b"\r\nhttps://example.com/\r\n", True),
+        ("no URL", b"\r\nwords only\r\n", False),
+        ("quoted-printable",
+         b"Content-Transfer-Encoding: quoted-printable\r\n"
+         b"\r\n=68ttps://example.com/\r\n", True),
+        ("UTF-16",
+         b"Content-Type: text/plain; charset=utf-16\r\n"
+         b"\r\n" + "https://example.com/".encode("utf-16"), True),
+    ))
+    def test(self, name, data, expect):
+        self.assertEqual(may_contain_url(data), expect)
+
+
+class TestEntryKey(TestCase):
+
+    """Regression tests for Robot.entry_key."""
+
+    @parameterized.expand((
+        ("no space", "*foo", "foo"),
+        ("space", "* foo", "foo"),
+        ("timestamp", "*  {{at|d}}  x", "x"),
+        ("timestamp, no space", "* {{at|d}}x", "x"),
+        ("unclosed timestamp", "* {{at|d x", "{{at|d x"),
+        ("bare star", "*", ""),
+        ("not a list item", "plain text", None),
+        ("indented", " * indented", None),
+        ("empty", "", None),
+    ))
+    def test(self, name, line, expect):
+        self.assertEqual(Robot.entry_key(line), expect)
+
+
+class StubJobQueue(IMAP4JobQueue):
+
+    """IMAP4JobQueue that answers from canned responses."""
+
+    HEADERS = "(UID BODY.PEEK[HEADER.FIELDS (TO CC BCC SUBJECT)])"
+
+    def __init__(self, headers, bodies):
+        self.mailbox = "INBOX"
+        self.headers = headers
+        self.bodies = bodies
+        self.fetched = []
+        self.stored = []
+
+    def select(self, mailbox):
+        return "OK", [str(len(self.headers)).encode()]
+
+    def uid(self, command, *args):
+        if command == "STORE":
+            self.stored.append(args)
+            return "OK", [None]
+        assert command == "FETCH"
+        if args == ("1:*", self.HEADERS):
+            return "OK", self.headers
+        imap_uid, items = args
+        assert items == "(BODY.PEEK[])"
+        self.fetched.append(imap_uid)
+        return "OK", [(b"1 (UID %s BODY[] {%d}"
+                       % (imap_uid, len(self.bodies[imap_uid])),
+                       self.bodies[imap_uid]),
+                      b")"]
+
+    def expunge(self):
+        return "OK", [None]
+
+
+class TestIMAP4JobQueue(TestCase):
+
+    """Tests for IMAP4JobQueue's header triage."""
+
+    def test_messages(self):
+        """Only unaddressed messages have their bodies fetched."""
+        fields = b"BODY[HEADER.FIELDS (TO CC BCC SUBJECT)]"
+        queue = StubJobQueue(
+            headers=[
+                # UID before the literal.
+                (b"1 (UID 3 " + fields + b" {2}", b"\r\n"),
+                b")",
+                # UID after the literal, addressed.
+                (b"2 (" + fields + b" {21}",
+                 b"To: me@example.com\r\n\r\n"),
+                b" UID 5)",
+                # UID after the literal.
+                (b"3 (" + fields + b" {2}", b"\r\n"),
+                b" UID 7)",
+            ],
+            bodies={
+                b"3": b"\r\nhttps://example.com/3\r\n",
+                b"7": b"\r\nhttps://example.com/7\r\n",
+            })
+        entries = [(msg.uid, Robot.entry_for(msg))
+                   for msg in queue.messages]
+        self.assertEqual(queue.fetched, [b"3", b"7"])
+        self.assertEqual(entries, [(b"3", "https://example.com/3"),
+                                   (b"7", "https://example.com/7")])
+
+    def test_blank_subject(self):
+        """Whitespace-only subjects don't trigger the URL prefilter."""
+        fields = b"BODY[HEADER.FIELDS (TO CC BCC SUBJECT)]"
+        queue = StubJobQueue(
+            headers=[
+                (b"1 (UID 3 " + fields + b" {15}",
+                 b"Subject:\r\n \r\n\r\n"),
+                b")",
+            ],
+            bodies={
+                b"3": b"Subject:\r\n \r\n\r\nsome words here\r\n",
+            })
+        entries = [(msg.uid, Robot.entry_for(msg))
+                   for msg in queue.messages]
+        self.assertEqual(entries, [(b"3", "some words here")])
+
+
+class StubPage(object):
+
+    """Page that only has text."""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class StubRobot(Robot):
+
+    """Robot that records what it would save."""
+
+    def __init__(self, queue):
+        self._mbox = queue
+        self._site = "stub site"
+        self.saved = []
+
+    def getOption(self, option):
+        return option == "always"
+
+    def put_current(self, new_text, **kwargs):
+        self.saved.append(new_text)
+
+
+class TestTreatPage(TestCase):
+
+    """Regression tests for Robot.treat_page."""
+
+    @parameterized.expand((
+        ("trailing blank lines",
+         "* a\n* b\n\n  \n", ["{{at|d}} c"],
+         "* a\n* b\n* {{at|d}} c\n"),
+        ("empty page",
+         "", ["x"],
+         "\n* x\n"),
+        ("multi-line entries",
+         "* {{at|d1}} x\n", ["{{at|d2}} x", "{{at|d3}} y\nbody line"],
+         "* {{at|d1}} x\n* {{at|d3}} y\nbody line\n"),
+        ("existing duplicates",
+         "Intro\n* a\n*a\n", ["b", "a"],
+         "Intro\n* a\n* b\n"),
+    ))
+    def test(self, name, text, entries, expect):
+        robot = StubRobot(StubJobQueue([], {}))
+        robot._current_page = StubPage(text)
+        robot.entries = entries
+        robot.treat_page()
+        self.assertEqual(robot.saved, [expect])
+
+
+class TestGenerator(TestCase):
+
+    """Tests for Robot.generator."""
+
+    FIELDS = b"BODY[HEADER.FIELDS (TO CC BCC SUBJECT)]"
+
+    def queue(self, bodies):
+        return StubJobQueue(
+            headers=[item
+                     for imap_uid in bodies
+                     for item in ((b"1 (UID %s %s {2}"
+                                   % (imap_uid, self.FIELDS), b"\r\n"),
+                                  b")")],
+            bodies=bodies)
+
+    def test_flags_in_one_store(self):
+        """Accepted messages, duplicates included, get one STORE."""
+        queue = self.queue({
+            b"3": b"Date: Mon, 02 Jan 2023 10:00:00 +0000\r\n"
+                  b"\r\nhttps://example.com/a\r\n",
+            b"5": b"Date: Tue, 03 Jan 2023 10:00:00 +0000\r\n"
+                  b"\r\nhttps://example.com/a\r\n",
+            b"7": b"\r\nhttps://example.com/b\r\n",
+            b"9": b"\r\n\r\n",
+        })
+        robot = StubRobot(queue)
+        with patch("pywikibot.Page") as page:
+            self.assertEqual(list(robot.generator), [page.return_value])
+        self.assertEqual(robot.entries, [
+            "{{at|Mon, 02 Jan 2023 10:00:00 +0000}} https://example.com/a",
+            "https://example.com/b",
+        ])
+        self.assertEqual(queue.stored,
+                         [(b"3,5,7", "+FLAGS.SILENT", r"(\Deleted)")])
+
+    def test_nothing_accepted(self):
+        """No STORE is sent and no page is yielded if nothing is new."""
+        queue = self.queue({b"3": b"\r\n\r\n"})
+        robot = StubRobot(queue)
+        with patch("pywikibot.Page") as page:
+            self.assertEqual(list(robot.generator), [])
+        page.assert_not_called()
+        self.assertEqual(queue.stored, [])